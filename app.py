@@ -687,6 +687,10 @@ def api_update_installation_status():
     """
     Receive status and log updates from the vpc_ce_installation.py script.
     Updates the server status in the database and logs the message.
+
+    The body is either a single update with phase and message, or a batch
+    with an "entries" list of {phase, message} objects that the installer
+    queued up while a previous request was in flight.
     """
     try:
         data = request.get_json()
@@ -698,18 +702,27 @@ def api_update_installation_status():
         # Accept either node_id (for backward compatibility) or management_ip (preferred)
         node_id = data.get('node_id')
         management_ip = data.get('management_ip', node_id)  # Default to node_id if management_ip not provided
-        phase = data.get('phase')
-        message = data.get('message')
+        entries = data.get('entries')
+        if entries is None:
+            entries = [{'phase': data.get('phase'), 'message': data.get('message')}]
+
+        entries_valid = isinstance(entries, list) and entries and all(
+            isinstance(entry, dict) and entry.get('phase') is not None and entry.get('message') is not None
+            for entry in entries)
 
-        if (node_id is None and management_ip is None) or phase is None or message is None:
+        if (node_id is None and management_ip is None) or not entries_valid:
             return jsonify({'error': 'Missing required fields: either node_id or management_ip, plus phase and message'}), 400
 
         # Use management_ip for logging if available, otherwise use node_id
         identifier = management_ip if management_ip else node_id
         
-        # Log the message to the server log file
-        log_message = f"Node {identifier} - Phase {phase}: {message}"
-        logger.info(log_message) # This will use the configured logger which writes to file and console
+        # Log each message to the server log file
+        for entry in entries:
+            log_message = f"Node {identifier} - Phase {entry['phase']}: {entry['message']}"
+            logger.info(log_message) # This will use the configured logger which writes to file and console
+
+        # Entries arrive in order, so the last one decides the resulting status
+        phase = entries[-1]['phase']
 
         # Update the server status in the database
         # Assuming 'nodes' table and updating 'deployment_status' and 'updated_at'
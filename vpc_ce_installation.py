@@ -16,20 +16,41 @@ import sys
 import os
 import time
 import subprocess
+import shutil
 import json
 import socket
-import hashlib
 import uuid
 import glob
+import fnmatch
 from random import randint
-import urllib.request
-import urllib.error
+import urllib.parse
+import http.client
 import re
+import queue
+import threading
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 
 # Global variables to store management_ip and config_server
 management_ip = None
 config_server = None
 
+# Status updates are posted from a background thread so a slow config
+# server never stalls the installation
+status_queue = queue.Queue()
+status_thread = None
+
+# Most updates the worker folds into one POST when messages queue up faster
+# than the config server acknowledges them
+STATUS_BATCH_SIZE = 16
+
+# Keep-alive connections to the config server, keyed by (scheme, netloc), so
+# the stream of status updates doesn't pay a TCP handshake per message
+http_connections = {}
+
+# NVMe namespace block devices (nvme0n1, ...) but not their partitions
+NVME_NAMESPACE_RE = re.compile(r'^nvme\d+n\d+$')
+
 def drop_to_shell(error_msg):
     """
     Drop to an interactive shell for debugging when a critical error occurs.
@@ -46,6 +67,9 @@ def drop_to_shell(error_msg):
     log("Dropping to interactive shell for debugging...")
     log("You can now connect via serial console")
     
+    # exec skips atexit handlers, so deliver the last messages now
+    flush_status_updates()
+    
     # Print a visible separator to make it clear we're entering a shell
     print("\n" + "="*60)
     print(">>> ENTERING INTERACTIVE DEBUG SHELL <<<")
@@ -392,12 +416,10 @@ def install_hypervisor(config):
        search_locations = ['/mnt/ahv', '/mnt/stage', '/mnt/install']
        search_patterns = ['grubx64.efi', 'BOOTX64.EFI', 'shimx64.efi']
        
+       # One walk per location; the stable sort keeps the old per-pattern order
        for location in search_locations:
-           for pattern in search_patterns:
-               result = subprocess.run(['find', location, '-name', pattern, '-type', 'f'],
-                                     capture_output=True, text=True)
-               if result.stdout.strip():
-                   grub_efi_paths.extend(result.stdout.strip().split('\n'))
+           found = [path for path in find_files(location, *search_patterns) if os.path.isfile(path)]
+           grub_efi_paths.extend(sorted(found, key=lambda path: search_patterns.index(os.path.basename(path))))
        
        if grub_efi_paths:
            grub_efi_path = grub_efi_paths[0]
@@ -584,11 +606,10 @@ early_microcode="no"
             log("Dracut failed - falling back to ISO initramfs")
             
             # Copy initramfs from ISO
-            result = subprocess.run(['find', '/mnt/ahv', '-name', 'initramfs*'],
-                                capture_output=True, text=True)
+            iso_initramfs = find_files('/mnt/ahv', 'initramfs*')
             
-            if result.stdout.strip():
-                initramfs_path = result.stdout.strip().split('\n')[0]
+            if iso_initramfs:
+                initramfs_path = iso_initramfs[0]
                 subprocess.run(['cp', initramfs_path, f'/mnt/stage/boot/initramfs-{kernel_version}.img'])
                 log(f"Copied initramfs from ISO: {initramfs_path}")
                 
@@ -618,19 +639,14 @@ early_microcode="no"
        # Copy kernel and initramfs to required locations
        log("Setting up kernel and initramfs files...")
        
-       # Find kernel and initramfs files
+       # Find kernel and initramfs files in a single walk of the installed system
        kernel_files = []
        initramfs_files = []
-       
-       result = subprocess.run(['find', '/mnt/stage', '-name', 'vmlinuz*'],
-                             capture_output=True, text=True)
-       if result.stdout.strip():
-           kernel_files = result.stdout.strip().split('\n')
-       
-       result = subprocess.run(['find', '/mnt/stage', '-name', 'initramfs*'],
-                             capture_output=True, text=True)
-       if result.stdout.strip():
-           initramfs_files = result.stdout.strip().split('\n')
+       for path in find_files('/mnt/stage', 'vmlinuz*', 'initramfs*'):
+           if os.path.basename(path).startswith('vmlinuz'):
+               kernel_files.append(path)
+           else:
+               initramfs_files.append(path)
        
        # Copy to standard locations
        if kernel_files:
@@ -711,18 +727,52 @@ early_microcode="no"
 
 def cleanup_mounts():
    """Clean up all mount points"""
-   mount_points = [
-       '/mnt/stage/boot/efi',
-       '/mnt/stage', 
-       '/mnt/install',
-       '/mnt/ahv'
+   # Nested mounts must go before their parents, and /mnt/install is
+   # loop-mounted from an image on /mnt/ahv so it must go before that;
+   # mounts within a layer are independent and are unmounted in parallel
+   mount_layers = [
+       ['/mnt/stage/boot/efi'],
+       ['/mnt/install'],
+       ['/mnt/stage', '/mnt/ahv']
    ]
    
-   for mount_point in mount_points:
-       try:
-           subprocess.run(['umount', mount_point], capture_output=True)
-       except:
-           pass
+   for mount_points in mount_layers:
+       procs = []
+       for mount_point in mount_points:
+           try:
+               procs.append((mount_point, subprocess.Popen(['umount', mount_point],
+                                                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)))
+           except OSError:
+               pass
+       for mount_point, proc in procs:
+           try:
+               proc.wait(timeout=5)
+           except subprocess.TimeoutExpired:
+               # Don't leave a stray umount behind to hold up the next layer.
+               # A umount stuck flushing writes can't be killed and finishes
+               # anyway, so only report points that really stayed mounted
+               proc.kill()
+               proc.wait()
+               if os.path.ismount(mount_point):
+                   log(f"Timed out unmounting {mount_point}")
+
+def find_files(root, *patterns):
+   """
+   In-process equivalent of `find root -name pat1 -o -name pat2 ...`.
+   
+   Args:
+       root: Directory to walk
+       patterns: One or more fnmatch patterns matched against the file name
+       
+   Returns:
+       A list of matching paths in walk order
+   """
+   matches = []
+   for dirpath, dirnames, filenames in os.walk(root):
+       for name in dirnames + filenames:
+           if any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns):
+               matches.append(os.path.join(dirpath, name))
+   return matches
 
 def setup_environment(config):
     """Set up installation environment"""
@@ -738,25 +788,53 @@ def setup_environment(config):
     
     log("Environment setup complete")
 
+def read_sysfs_files(paths):
+    """
+    Read a batch of small sysfs attribute files.
+    
+    Each attribute fits in one page, so a file costs exactly one open, read
+    and close on a raw fd, without the buffered text layer of open().
+    
+    Args:
+        paths: The files to read
+        
+    Returns:
+        A dict mapping each path that could be read to its stripped contents
+    """
+    contents = {}
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            contents[path] = os.read(fd, 4096).decode().strip()
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+    return contents
+
 def generate_cluster_id():
     """Generate cluster ID from MAC addresses"""
     log("Generating cluster_id")
-    randomizer_hex = hex(randint(1, int('7FFF', 16)))[2:]
-    mac_addrs = []
-    pcibase = "/sys/devices/pci"
-    for net in glob.glob("/sys/class/net/*"):
-      if not os.path.realpath(net).startswith(pcibase):
-        continue
-      try:
-          with open("%s/address" % net, 'r') as f:
-              mac_addrs.append(f.read().strip())
-      except IOError:
-          log(f"Could not read MAC address for {net}")
-    mac_addrs.sort()
+    randomizer = randint(1, 0x7FFF)
+    # Entries are relative symlinks into /sys/devices, so one readlink per
+    # NIC tells PCI devices apart without realpath's per-component lstat calls
+    pcibase = "../../devices/pci"
+    with os.scandir("/sys/class/net") as entries:
+        nets = [entry.path for entry in entries
+                if entry.is_symlink() and os.readlink(entry.path).startswith(pcibase)]
+    address_paths = ["%s/address" % net for net in nets]
+    addresses = read_sysfs_files(address_paths)
+    for net, path in zip(nets, address_paths):
+        if path not in addresses:
+            log(f"Could not read MAC address for {net}")
+    mac_addrs = sorted(addresses.values())
+    # The random bits sit above the 48-bit MAC
+    cluster_id = randomizer << 48
     if mac_addrs:
-        cluster_id = int(randomizer_hex + mac_addrs[0].replace(':', ''), 16)
-    else:
-        cluster_id = int(randomizer_hex + "000000000000", 16)
+        cluster_id |= int(mac_addrs[0].replace(':', ''), 16)
     return cluster_id
 
 def create_installation_params(config):
@@ -773,75 +851,79 @@ def create_installation_params(config):
             config['node'] = {}
             
         node_config = config['node']
-        params.block_id = node_config.get('block_id', str(uuid.uuid4()).split('-')[0])
-        params.node_position = node_config.get('node_position', "A")
-        params.node_serial = node_config.get('node_serial', str(uuid.uuid4()))
-        params.cluster_id = node_config.get('cluster_id', generate_cluster_id())
-        
-        # Hardware configuration
         hw_config = config['hardware']
-        params.model = hw_config['model']
-        params.model_string = hw_config['model']
-        params.boot_disk = hw_config['boot_disk']
-        params.boot_disk_model = hw_config.get('boot_disk_model', 'Generic')
-        params.boot_disk_sz_GB = hw_config['boot_disk_size_gb']
-        params.hw_layout = None
-        
-        # Installation type
-        params.hyp_type = 'kvm'
-        params.hyp_install_type = 'clean'
-        params.svm_install_type = 'clean'
-        params.installer_path = '/tmp/nutanix_installer_package.tar.gz'
-        
-        # Resource configuration
         resources = config['resources']
-        params.svm_gb_ram = resources['cvm_memory_gb']
-        params.svm_num_vcpus = resources['cvm_vcpus']
+        network_config = config['network']
         
-        # Disk layout
-        if isinstance(hw_config['cvm_data_disks'], str):
-            params.ce_cvm_data_disks = [hw_config['cvm_data_disks']]
-        else:
-            params.ce_cvm_data_disks = hw_config['cvm_data_disks']
+        # Ensure the disk lists are lists, even if they're strings in the config
+        cvm_data_disks = hw_config['cvm_data_disks']
+        if isinstance(cvm_data_disks, str):
+            cvm_data_disks = [cvm_data_disks]
+        cvm_boot_disks = hw_config['cvm_boot_disks']
+        if isinstance(cvm_boot_disks, str):
+            cvm_boot_disks = [cvm_boot_disks]
+        
+        param_values = {
+            # Node configuration
+            'block_id': node_config.get('block_id', uuid.uuid4().hex[:8]),
+            'node_position': node_config.get('node_position', "A"),
+            'node_serial': node_config.get('node_serial', str(uuid.uuid4())),
+            'cluster_id': node_config.get('cluster_id', generate_cluster_id()),
             
-        if isinstance(hw_config['cvm_boot_disks'], str):
-            params.ce_cvm_boot_disks = [hw_config['cvm_boot_disks']]
-        else:
-            params.ce_cvm_boot_disks = hw_config['cvm_boot_disks']
+            # Hardware configuration
+            'model': hw_config['model'],
+            'model_string': hw_config['model'],
+            'boot_disk': hw_config['boot_disk'],
+            'boot_disk_model': hw_config.get('boot_disk_model', 'Generic'),
+            'boot_disk_sz_GB': hw_config['boot_disk_size_gb'],
+            'hw_layout': None,
             
-        params.ce_hyp_boot_disk = hw_config['hypervisor_boot_disk']
-        
-        if isinstance(hw_config['cvm_data_disks'], str):
-            params.ce_disks = [hw_config['boot_disk']] + [hw_config['cvm_data_disks']]
-        else:
-            params.ce_disks = [hw_config['boot_disk']] + hw_config['cvm_data_disks']
-        
-        # Community Edition settings
-        params.ce_eula_accepted = True
-        params.ce_eula_viewed = True
-        params.create_1node_cluster = False
+            # Installation type
+            'hyp_type': 'kvm',
+            'hyp_install_type': 'clean',
+            'svm_install_type': 'clean',
+            'installer_path': '/tmp/nutanix_installer_package.tar.gz',
+            
+            # Resource configuration
+            'svm_gb_ram': resources['cvm_memory_gb'],
+            'svm_num_vcpus': resources['cvm_vcpus'],
+            
+            # Disk layout
+            'ce_cvm_data_disks': cvm_data_disks,
+            'ce_cvm_boot_disks': cvm_boot_disks,
+            'ce_hyp_boot_disk': hw_config['hypervisor_boot_disk'],
+            'ce_disks': [hw_config['boot_disk']] + cvm_data_disks,
+            
+            # Community Edition settings
+            'ce_eula_accepted': True,
+            'ce_eula_viewed': True,
+            'create_1node_cluster': False,
+            
+            # Version information
+            'nos_version': '6.8.0',
+            'svm_version': '6.8.0',
+            'hyp_version': 'el8.nutanix.20230302.101026',
+            'phoenix_version': '4.6',
+            'foundation_version': '4.6',
+            
+            # Configure CVM network interface
+            'cvm_interfaces': [
+                {
+                    "name": "eth0",
+                    "ip": network_config['cvm_ip'],
+                    "netmask": network_config['cvm_netmask'], 
+                    "gateway": network_config['cvm_gateway'],
+                    "vswitch": "br0"
+                }
+            ],
+            
+            # Set DNS servers
+            'dns_ip': ",".join(network_config['dns_servers']),
+        }
         
-        # Version information
-        params.nos_version = '6.8.0'
-        params.svm_version = '6.8.0'
-        params.hyp_version = 'el8.nutanix.20230302.101026'
-        params.phoenix_version = '4.6'
-        params.foundation_version = '4.6'
-
-        # Configure CVM network interface
-        network_config = config['network']
-        params.cvm_interfaces = [
-            {
-                "name": "eth0",
-                "ip": network_config['cvm_ip'],
-                "netmask": network_config['cvm_netmask'], 
-                "gateway": network_config['cvm_gateway'],
-                "vswitch": "br0"
-            }
-        ]
-
-        # Set DNS servers
-        params.dns_ip = ",".join(network_config['dns_servers'])
+        # Go through setattr so ParamList still sees every assignment
+        for name, value in param_values.items():
+            setattr(params, name, value)
         
         log("Installation parameters created")
         return params
@@ -859,14 +941,28 @@ def cleanup_previous_attempts():
         '/tmp/svm_marker'
     ]
     
+    def remove_path(path):
+        if os.path.isdir(path) and not os.path.islink(path):
+            # Like rm -rf, keep removing what can be removed and only fail at the end
+            errors = []
+            # onerror is deprecated from Python 3.12 in favour of onexc
+            if sys.version_info >= (3, 12):
+                shutil.rmtree(path, onexc=lambda function, failed_path, exc: errors.append(failed_path))
+            else:
+                shutil.rmtree(path, onerror=lambda function, failed_path, exc_info: errors.append(failed_path))
+            if errors:
+                raise OSError(f"Could not remove {len(errors)} entries under {path}, e.g. {errors[0]}")
+            log(f"Removed directory: {path}")
+        elif os.path.lexists(path):
+            # Files and symlinks (including ones to directories), as rm -rf did
+            os.remove(path)
+            log(f"Removed file: {path}")
+    
     try:
-        for path in cleanup_paths:
-            if os.path.isdir(path):
-                subprocess.run(['rm', '-rf', path], check=True)
-                log(f"Removed directory: {path}")
-            elif os.path.isfile(path):
-                os.remove(path)
-                log(f"Removed file: {path}")
+        # The paths are independent, so remove them in parallel and in-process;
+        # list() re-raises the first failure
+        with ThreadPoolExecutor(max_workers=len(cleanup_paths)) as executor:
+            list(executor.map(remove_path, cleanup_paths))
         
         log("Cleanup completed")
         return True
@@ -875,35 +971,134 @@ def cleanup_previous_attempts():
         log(f"Cleanup failed: {e}")
         return False
 
+def post_json(url, payload):
+    """
+    POST a JSON payload over a keep-alive connection to the URL's server,
+    reconnecting once if the server has closed it since the last request.
+    
+    Args:
+        url: The full request URL
+        payload: The object to send as the JSON body
+        
+    Returns:
+        The HTTP status code
+    """
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    key = (parts.scheme, parts.netloc)
+    data = json.dumps(payload).encode('utf-8')
+    
+    while True:
+        conn = http_connections.get(key)
+        reused = conn is not None
+        if not reused:
+            if parts.scheme == 'https':
+                conn = http.client.HTTPSConnection(parts.netloc, timeout=10)
+            else:
+                conn = http.client.HTTPConnection(parts.netloc, timeout=10)
+            http_connections[key] = conn
+        try:
+            conn.request('POST', path, body=data, headers={'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            # Drain the body so the connection can carry the next request
+            response.read()
+            return response.status
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            conn.close()
+            del http_connections[key]
+            # Only a reused keep-alive connection that the server dropped is
+            # retried; anything else (a timeout in particular) may mean the
+            # server already has the request, so it isn't sent twice
+            if not reused:
+                raise
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            del http_connections[key]
+            raise
+
 def send_status_update(management_ip, phase, message):
     """
-    Sends status and log messages to the PXE config server API using urllib.
+    Queues a status or log message for the PXE config server API and returns
+    immediately; a background worker thread delivers queued messages in order.
     
     Args:
         management_ip: The IP address of the management interface
         phase: The installation phase number or "error" for error messages
         message: The status message to send
     """
-    global config_server
+    global config_server, status_thread
     if not config_server:
         return
     
-    api_url = f"{config_server}/api/installation/status"
-    payload = {
-        "management_ip": management_ip,
-        "phase": phase,
-        "message": message
-    }
+    if status_thread is None:
+        status_thread = threading.Thread(target=status_update_worker, daemon=True)
+        status_thread.start()
+        atexit.register(flush_status_updates)
     
-    # Convert payload to JSON and encode
-    data = json.dumps(payload).encode('utf-8')
+    status_queue.put_nowait((management_ip, phase, message))
+
+def status_update_worker():
+    """
+    Deliver queued status updates to the config server in order. Anything
+    queued while the previous POST was in flight goes out as one batch.
+    """
+    while True:
+        batch = [status_queue.get()]
+        while len(batch) < STATUS_BATCH_SIZE:
+            try:
+                batch.append(status_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            # Consecutive updates for the same node share one request
+            start = 0
+            for end in range(1, len(batch) + 1):
+                if end == len(batch) or batch[end][0] != batch[start][0]:
+                    post_status_update(batch[start][0], batch[start:end])
+                    start = end
+        finally:
+            for _ in batch:
+                status_queue.task_done()
+
+def flush_status_updates(timeout=10):
+    """
+    Wait for queued status updates to be delivered, e.g. before rebooting
+    or exec'ing a shell, so the last messages are not lost.
+    
+    Args:
+        timeout: Maximum number of seconds to wait
+    """
+    deadline = time.time() + timeout
+    while status_queue.unfinished_tasks and time.time() < deadline:
+        time.sleep(0.1)
+
+def post_status_update(management_ip, updates):
+    """
+    Sends one request with the given updates for a node: the single-message
+    body for one update, or an "entries" list for several.
+    
+    Args:
+        management_ip: The IP address of the management interface
+        updates: List of (management_ip, phase, message) tuples, oldest first
+    """
+    api_url = f"{config_server}/api/installation/status"
+    if len(updates) == 1:
+        _, phase, message = updates[0]
+        payload = {
+            "management_ip": management_ip,
+            "phase": phase,
+            "message": message
+        }
+    else:
+        payload = {
+            "management_ip": management_ip,
+            "entries": [{"phase": phase, "message": message} for _, phase, message in updates]
+        }
     
     try:
-        req = urllib.request.Request(api_url, data=data, method='POST')
-        req.add_header('Content-Type', 'application/json')
-        
-        response = urllib.request.urlopen(req, timeout=10)
-        status_code = response.getcode()
+        status_code = post_json(api_url, payload)
         
         if not (200 <= status_code < 300):
             log(f"Status update failed with HTTP {status_code}", send_to_api=False)
@@ -914,10 +1109,17 @@ def send_status_update(management_ip, phase, message):
 
 def wipe_nvmes():
     """Wipe all NVMe drives"""
-    drives = [d for d in glob.glob('/dev/nvme*') if re.match(r'.*/nvme\d+n\d+', d)]
-    for drive in sorted(drives):
+    with os.scandir('/dev') as entries:
+        drives = sorted(entry.path for entry in entries if NVME_NAMESPACE_RE.match(entry.name))
+    
+    # The drives are independent, so wipe them all at once and wait for the slowest
+    procs = {}
+    for drive in drives:
         log(f"Wiping {drive}")
-        subprocess.run(['wipefs', '-a', drive], check=True)
+        procs[drive] = subprocess.Popen(['wipefs', '-a', drive])
+    failed = [drive for drive, proc in procs.items() if proc.wait() != 0]
+    if failed:
+        raise RuntimeError(f"wipefs failed on {', '.join(failed)}")
     log(f"Wiped {len(drives)} drives")
 
 def verify_installation(config):
@@ -1114,7 +1316,7 @@ def main():
     # Ensure node configuration exists
     if 'node' not in config:
         config['node'] = {
-            'block_id': str(uuid.uuid4()).split('-')[0],
+            'block_id': uuid.uuid4().hex[:8],
             'node_position': 'A',
             'node_serial': str(uuid.uuid4()),
             'cluster_id': generate_cluster_id()
@@ -1140,6 +1342,7 @@ def main():
     
     # Phase 8: Reboot Server
     log("Installation complete. Rebooting server.", phase=8)
+    flush_status_updates()
     subprocess.run(['reboot'])
     
     log("Installation completed successfully!")